@@ -1,11 +1,19 @@
 #!/usr/bin/env python3
 """Monitor TCF and TEF registration status and notify via ntfy.sh on changes."""
 
+import codecs
+import contextlib
+import difflib
+import http.client
 import json
 import os
-import re
 import sys
-import urllib.request
+import threading
+import time
+import urllib.error
+import urllib.parse
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from html.parser import HTMLParser
 
 PAGES = {
@@ -13,19 +21,48 @@ PAGES = {
     "TEF": "https://www.afvictoria.ca/exams/tef/",
 }
 NTFY_TOPIC = "tcf-registration-alert"
+USER_AGENT = "TCF-Monitor/1.0"
+
+# Redirect statuses followed for GET requests, and how many hops to allow
+REDIRECTS = frozenset((301, 302, 303, 307, 308))
+MAX_REDIRECTS = 5
 
 # Gist-based state storage (set env vars for Render; falls back to local file)
 GIST_ID = os.environ.get("GIST_ID")
 GITHUB_TOKEN = os.environ.get("GITHUB_TOKEN")
 STATE_FILE = os.environ.get("STATE_FILE", "last_state.json")
 
+# Seconds between checks when run as a long-lived process. Unset (the
+# default) checks once and exits, for cron.
+POLL_INTERVAL = int(os.environ.get("POLL_INTERVAL") or 0)
+
+# Pages are read and parsed in chunks of this many bytes
+CHUNK_SIZE = 32 * 1024
+
+# Lines containing these substrings (lowercased) carry session/status info.
+# Lines are whitespace-normalized, so a colon is preceded by at most one
+# space; "next session:" is covered by "session:".
+KEYWORDS = (
+    "session:",
+    "session :",
+    "status:",
+    "status :",
+    "registration starts",
+)
+
 # Lines containing these substrings (lowercased) are filtered out
-NOISE = [
+NOISE = (
     "please check regularly",
     "register for the",
     "register for tef",
     "if no dates are available",
-]
+)
+
+# Tags that end the current line, and tags that also end it when closed
+BREAK_TAGS = frozenset(("p", "br", "h1", "h2", "h3", "tr", "td"))
+HEADING_TAGS = frozenset(("h1", "h2", "h3"))
+# Tags whose content is never page text
+SKIP_TAGS = frozenset(("script", "style"))
 
 
 class SessionParser(HTMLParser):
@@ -39,46 +76,47 @@ class SessionParser(HTMLParser):
     def __init__(self):
         super().__init__()
         self.lines = []
-        self._current_line = ""
+        self._current_line = []
         self._in_strong = False
+        self._in_skipped = False
 
     def _flush(self):
-        text = " ".join(self._current_line.split())
+        text = " ".join("".join(self._current_line).split())
         if text:
             self.lines.append(text)
-        self._current_line = ""
+        self._current_line.clear()
 
     def handle_starttag(self, tag, attrs):
-        if tag in ("p", "br", "h1", "h2", "h3", "tr", "td"):
+        if tag in BREAK_TAGS:
             self._flush()
         elif tag == "hr":
             self._flush()
             self.lines.append("---")
         elif tag == "strong":
             self._in_strong = True
+        elif tag in SKIP_TAGS:
+            self._in_skipped = True
 
     def handle_endtag(self, tag):
-        if tag in ("h1", "h2", "h3"):
+        if tag in HEADING_TAGS:
             self._flush()
         elif tag == "strong":
             self._in_strong = False
+        elif tag in SKIP_TAGS:
+            self._in_skipped = False
 
     def handle_data(self, data):
-        self._current_line += data
+        if not self._in_skipped:
+            self._current_line.append(data)
 
-    def get_text(self):
+    def get_lines(self):
         self._flush()
-        # Match lines containing session/status info
-        pattern = re.compile(
-            r"(next session\s*:|session\s*:|status\s*:|registration starts)",
-            re.IGNORECASE,
-        )
         result = []
         for line in self.lines:
             low = line.lower()
             if line == "---":
                 result.append(line)
-            elif pattern.search(low):
+            elif any(k in low for k in KEYWORDS):
                 if low == "next sessions":
                     result.append("---")
                 elif not any(n in low for n in NOISE):
@@ -93,32 +131,175 @@ class SessionParser(HTMLParser):
         while cleaned and cleaned[-1] == "---":
             cleaned.pop()
 
-        return "\n".join(cleaned)
+        return cleaned
+
 
+# --- HTTP (keep-alive connections shared across requests) ---
 
-def fetch_page(url):
-    req = urllib.request.Request(url, headers={"User-Agent": "TCF-Monitor/1.0"})
-    with urllib.request.urlopen(req, timeout=30) as resp:
-        return resp.read().decode("utf-8")
+_idle_connections = {}
+_idle_lock = threading.Lock()
+
+
+def _checkout(host, timeout):
+    with _idle_lock:
+        idle = _idle_connections.get(host)
+        if idle:
+            return idle.pop(), True
+    return http.client.HTTPSConnection(host, timeout=timeout), False
+
+
+def _checkin(host, conn):
+    with _idle_lock:
+        _idle_connections.setdefault(host, []).append(conn)
+
+
+def _send(host, method, path, body, headers, timeout):
+    """Send one request on a pooled connection to host; return (conn, resp)."""
+    conn, reused = _checkout(host, timeout)
+    try:
+        conn.request(method, path, body=body, headers=headers)
+        return conn, conn.getresponse()
+    except (http.client.RemoteDisconnected, ConnectionError):
+        conn.close()
+        if not reused:
+            raise
+    except BaseException:
+        conn.close()
+        raise
+    # The server dropped the idle connection; retry on a fresh one
+    conn = http.client.HTTPSConnection(host, timeout=timeout)
+    try:
+        conn.request(method, path, body=body, headers=headers)
+        return conn, conn.getresponse()
+    except BaseException:
+        conn.close()
+        raise
+
+
+def _release(host, conn, resp):
+    """Drain resp and return its connection to the pool if still usable."""
+    try:
+        resp.read()
+    except BaseException:
+        conn.close()
+        raise
+    if resp.will_close:
+        conn.close()
+    else:
+        _checkin(host, conn)
+
+
+@contextlib.contextmanager
+def _request(method, url, body=None, headers=None, timeout=30):
+    """Send a request over a pooled HTTPS connection and yield the response.
+
+    GET requests follow up to MAX_REDIRECTS redirects. Responses other than
+    2xx and 304 raise urllib.error.HTTPError. Once the caller is done the
+    rest of the body is drained and the connection goes back to the pool,
+    so later requests to the same host skip the TCP/TLS handshake.
+    Connections are made directly; proxy settings such as HTTPS_PROXY are
+    not supported.
+    """
+    headers = {"User-Agent": USER_AGENT, **(headers or {})}
+
+    for _ in range(MAX_REDIRECTS + 1):
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        conn, resp = _send(parts.netloc, method, path, body, headers, timeout)
+        location = resp.getheader("Location")
+        if method != "GET" or resp.status not in REDIRECTS or not location:
+            break
+        _release(parts.netloc, conn, resp)
+        url = urllib.parse.urljoin(url, location)
+    else:
+        raise urllib.error.HTTPError(
+            url, resp.status, "Too many redirects", resp.headers, None
+        )
+
+    try:
+        if not (200 <= resp.status < 300 or resp.status == 304):
+            raise urllib.error.HTTPError(
+                url, resp.status, resp.reason, resp.headers, None
+            )
+        yield resp
+    except BaseException:
+        conn.close()
+        raise
+    _release(parts.netloc, conn, resp)
+
+
+def fetch_page(url, etag=None, last_modified=None):
+    """Request url; use as a context manager to stream the response.
+
+    With etag/last_modified from an earlier fetch the request is
+    conditional, and an unchanged page comes back as a bodiless 304.
+    The page is requested gzip-compressed; extract_status inflates it.
+    """
+    headers = {"Accept-Encoding": "gzip"}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    return _request("GET", url, headers=headers)
 
 
-def extract_status(html):
+def extract_status(resp):
+    """Parse the page as it arrives, chunk by chunk, and return its status."""
     parser = SessionParser()
-    parser.feed(html)
-    return parser.get_text()
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    inflater = None
+    if resp.headers.get("Content-Encoding") == "gzip":
+        inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)  # gzip wrapper
+    while chunk := resp.read(CHUNK_SIZE):
+        if inflater:
+            chunk = inflater.decompress(chunk)
+        parser.feed(decoder.decode(chunk))
+    if inflater:
+        parser.feed(decoder.decode(inflater.flush()))
+    parser.feed(decoder.decode(b"", final=True))
+    parser.close()
+    return parser.get_lines()
+
+
+def check_page(url, previous):
+    """Return the state entry for url, reusing previous if not modified."""
+    if not previous.get("lines"):
+        previous = {}
+    etag, last_modified = previous.get("etag"), previous.get("last_modified")
+    with fetch_page(url, etag, last_modified) as resp:
+        if resp.status == 304:
+            return previous
+        return {
+            "lines": extract_status(resp),
+            "etag": resp.headers.get("ETag"),
+            "last_modified": resp.headers.get("Last-Modified"),
+        }
 
 
 # --- State persistence (Gist or local file) ---
 
+def _as_entry(value):
+    # Older versions stored the status as one string: the whole entry
+    # before ETags were tracked, then under "text"
+    if isinstance(value, str):
+        return {"lines": value.splitlines()}
+    entry = dict(value or {})
+    if "text" in entry:
+        entry["lines"] = entry.pop("text").splitlines()
+    return entry
+
+
 def load_previous_state():
-    if GIST_ID and GITHUB_TOKEN:
-        return _load_state_gist()
+    if gist_state:
+        return gist_state.load()
     return _load_state_file()
 
 
 def save_state(state):
-    if GIST_ID and GITHUB_TOKEN:
-        _save_state_gist(state)
+    if gist_state:
+        gist_state.save_if_changed(state)
     else:
         _save_state_file(state)
 
@@ -136,101 +317,178 @@ def _save_state_file(state):
         json.dump(state, f, indent=2)
 
 
-def _load_state_gist():
-    req = urllib.request.Request(
-        f"https://api.github.com/gists/{GIST_ID}",
-        headers={
-            "Authorization": f"token {GITHUB_TOKEN}",
-            "Accept": "application/vnd.github+json",
-        },
-    )
-    try:
-        with urllib.request.urlopen(req, timeout=15) as resp:
-            gist = json.loads(resp.read().decode())
-            content = gist["files"]["last_state.json"]["content"]
-            return json.loads(content)
-    except (KeyError, json.JSONDecodeError, urllib.error.HTTPError) as e:
-        print(f"  Could not load gist state: {e}")
-        return {}
+# Single-file gist state written by older versions
+LEGACY_GIST_FILE = "last_state.json"
 
 
-def _save_state_gist(state):
-    payload = json.dumps({
-        "files": {
-            "last_state.json": {
-                "content": json.dumps(state, indent=2)
-            }
-        }
-    }).encode()
-    req = urllib.request.Request(
-        f"https://api.github.com/gists/{GIST_ID}",
-        data=payload,
-        headers={
-            "Authorization": f"token {GITHUB_TOKEN}",
+class GistState:
+    """Page state stored in a GitHub gist, one <page>.json file per page.
+
+    The file contents returned by load() are cached, so save_if_changed()
+    uploads only the pages whose serialized entry differs and makes no
+    request at all when nothing changed.
+    """
+
+    def __init__(self, gist_id, token):
+        self.url = f"https://api.github.com/gists/{gist_id}"
+        self.headers = {
+            "Authorization": f"token {token}",
             "Accept": "application/vnd.github+json",
-            "Content-Type": "application/json",
-        },
-        method="PATCH",
-    )
-    with urllib.request.urlopen(req, timeout=15) as resp:
-        print(f"  State saved to gist (HTTP {resp.status})")
+        }
+        self._cached = {}
+
+    def load(self):
+        try:
+            with _request("GET", self.url, headers=self.headers,
+                          timeout=15) as resp:
+                files = json.loads(resp.read())["files"]
+            self._cached = {
+                filename: file["content"] for filename, file in files.items()
+            }
+            state = {
+                name: json.loads(self._cached[f"{name}.json"])
+                for name in PAGES
+                if f"{name}.json" in self._cached
+            }
+            # Older versions kept every page in a single last_state.json,
+            # which is read only until the first save deletes it
+            if not state and LEGACY_GIST_FILE in self._cached:
+                state = json.loads(self._cached[LEGACY_GIST_FILE])
+            return state
+        except (KeyError, json.JSONDecodeError, urllib.error.HTTPError) as e:
+            print(f"  Could not load gist state: {e}")
+            return {}
+
+    def save_if_changed(self, state):
+        # Files left out of the PATCH keep their content
+        files = {}
+        for name, entry in state.items():
+            content = json.dumps(entry, separators=(",", ":"))
+            if content != self._cached.get(f"{name}.json"):
+                files[f"{name}.json"] = {"content": content}
+        if LEGACY_GIST_FILE in self._cached:
+            files[LEGACY_GIST_FILE] = None  # GitHub deletes the file
+        if not files:
+            return
+
+        payload = json.dumps({"files": files}, separators=(",", ":")).encode()
+        with _request(
+            "PATCH",
+            self.url,
+            body=payload,
+            headers={**self.headers, "Content-Type": "application/json"},
+            timeout=15,
+        ) as resp:
+            print(f"  State saved to gist (HTTP {resp.status})")
+        self._cached.pop(LEGACY_GIST_FILE, None)
+        for filename, file in files.items():
+            if file is not None:
+                self._cached[filename] = file["content"]
+
+
+gist_state = (
+    GistState(GIST_ID, GITHUB_TOKEN) if GIST_ID and GITHUB_TOKEN else None
+)
 
 
 # --- Notification ---
 
 def notify(name, old, new):
     title = f"{name} Registration Status Changed"
-    body = f"New status:\n{new}"
     if old:
-        body += f"\n\nPrevious status:\n{old}"
+        # Only the changed lines (with one line of context) are sent
+        diff = list(difflib.unified_diff(old, new, lineterm="", n=1))
+        # Drop the ---/+++ file header and the first @@ hunk marker; later
+        # markers become "…" so separate hunks don't read as adjacent
+        changes = [
+            "…" if line.startswith("@@") else line for line in diff[3:]
+        ]
+        body = "Changes:\n" + "\n".join(changes)
+    else:
+        body = "New status:\n" + "\n".join(new)
 
     data = body.encode("utf-8")
-    req = urllib.request.Request(
+    with _request(
+        "POST",
         f"https://ntfy.sh/{NTFY_TOPIC}",
-        data=data,
+        body=data,
         headers={
             "Title": title,
             "Priority": "high",
             "Tags": "rotating_light",
         },
-        method="POST",
-    )
-    with urllib.request.urlopen(req, timeout=15) as resp:
+        timeout=15,
+    ) as resp:
         print(f"  Notification sent (HTTP {resp.status})")
 
 
-def main():
-    previous_state = load_previous_state()
+def check(previous_state):
+    """Check every page once and return the new state, or None on failure."""
+    previous_pages = {
+        name: _as_entry(previous_state.get(name)) for name in PAGES
+    }
     current_state = {}
-    any_change = False
+    changed = []
 
+    # Pages are fetched concurrently; results are handled in PAGES order
     for name, url in PAGES.items():
         print(f"[{name}] Fetching {url} ...")
-        html = fetch_page(url)
-        current = extract_status(html)
+    with ThreadPoolExecutor(max_workers=len(PAGES)) as pool:
+        entries = pool.map(check_page, PAGES.values(), previous_pages.values())
+        entries = dict(zip(PAGES, entries))
 
+    for name, entry in entries.items():
+        current = entry["lines"]
         if not current:
-            print(f"  ERROR: Could not extract session info.", file=sys.stderr)
-            sys.exit(1)
+            print(f"[{name}] ERROR: Could not extract session info.",
+                  file=sys.stderr)
+            return None
 
-        current_state[name] = current
-        previous = previous_state.get(name)
+        current_state[name] = entry
+        previous = previous_pages[name].get("lines")
 
-        print(f"  Current status:\n{current}\n")
+        print(f"\n[{name}] Current status:")
+        print("\n".join(current) + "\n")
 
         if previous is None:
             print(f"  No previous state. Saving baseline.")
         elif current != previous:
             print(f"  STATUS CHANGED! Sending notification...")
-            notify(name, previous, current)
-            any_change = True
+            changed.append((name, previous, current))
         else:
             print(f"  No change.")
 
-    save_state(current_state)
+    # Notifications go out concurrently. The state is saved only once they
+    # have all succeeded, so a failed notification is retried next check.
+    if changed:
+        with ThreadPoolExecutor(max_workers=len(changed)) as pool:
+            pending = [pool.submit(notify, *change) for change in changed]
+            for future in pending:
+                future.result()
+
+    # Nothing to persist when every page came back identical
+    if current_state != previous_state:
+        save_state(current_state)
 
-    if not any_change and previous_state:
+    if not changed and previous_state:
         print("\nNo changes detected on any page.")
+    return current_state
+
+
+def main():
+    state = load_previous_state()
+    if not POLL_INTERVAL:
+        if check(state) is None:
+            sys.exit(1)
+        return
+
+    # State and pooled connections stay in memory between checks
+    while True:
+        try:
+            state = check(state) or state
+        except Exception as e:
+            print(f"ERROR: {e}", file=sys.stderr)
+        time.sleep(POLL_INTERVAL)
 
 
 if __name__ == "__main__":